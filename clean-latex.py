@@ -14,9 +14,11 @@
 
 import argparse
 import os
+import sys
 from shutil import copyfile
 from libclean import remove_comments, getscope, evaluate_header,\
-                     replace_commands
+                     replace_commands, read_bibliography, find_citations,\
+                     Report
 parser = argparse.ArgumentParser()
 parser.add_argument('-i', action='store', type=str)
 parser.add_argument('-o', action='store', type=str)
@@ -24,13 +26,20 @@ parser.add_argument('-d', action='store', type=str)
 parser.add_argument('--defines', action='store', type=str, default="")
 parser.add_argument('--enumerate-figures', action='store_const',
                     default=False, const=True)
+parser.add_argument('--report', choices=('text','json'), default='text')
+parser.add_argument('--verbose', action='store_true')
 args = parser.parse_args()
+report = Report("clean-latex")
+
+# Verbose output goes to stderr if stdout carries the JSON report:
+LOG = sys.stderr if args.report == 'json' else sys.stdout
 
 FILE = args.i   #'pbpsha_paper.tex'
 OUTFILE = args.o   # 'jgr-submit-clean.tex'
 OUTDIR = args.d
 DEFINES = tuple(args.defines.split(",")) #('\\agudraft',)
-print("DEFINES:",DEFINES)
+if args.verbose:
+    print("DEFINES:",DEFINES,file=LOG)
 
 if FILE is None:
     raise RuntimeError("No input file given.")
@@ -43,7 +52,7 @@ elif OUTDIR is None:
 with open(OUTFILE, 'w') as dest:
     with open(FILE, 'r') as f:
         remove_comments(f, dest)
-
+report.stage("remove_comments")
 
 ########################################################
 #                                                      #
@@ -66,6 +75,8 @@ command_order += ["\\replaced", "\\added", "\\deleted", "\\replacedincaption", "
                   "\\deletedincaption", "\\listofchanges","\\replacedlabel","\\drafttrue",
                   "\\countchange"]
 command_order = command_order[::-1]
+report.record["counts"]["commands"] = len(command_order)
+report.stage("evaluate_header")
 
 
 ##########################################
@@ -78,6 +89,7 @@ document, commands = replace_commands("\n".join(LINES), command_order, commands)
 
 with open(OUTFILE, "w") as f:
     f.write(document)
+report.stage("replace_commands")
 
 
 
@@ -161,6 +173,7 @@ for line in lines_in:
 document = "\n".join(s[0] for s in lines_out)
 with open(OUTFILE, "w") as f:
     f.write(document)
+report.stage("formatting")
 
 
 
@@ -173,36 +186,34 @@ split = document.split("\\bibliography{")
 if len(split) == 2:
     bibfile, i1 = getscope("{"+split[1], 0)
     split[1] = split[1][i1:]
-    print("bibliography:",bibfile)
+    if args.verbose:
+        print("bibliography:",bibfile,file=LOG)
     
     # Read the bibliography:
-    bibliography = dict()
-    with open(bibfile, 'r') as f:
-        entry = None
-        entrylines = []
-        for line in f:
-            line = line.strip()
-            if len(line) == 0 or line[0] == '%':
-                continue
-            if line[0] == '@':
-                assert '{' in line
-                assert line[-1] == ','
-                if entry is not None:
-                    bibliography[entry] = entrylines
-                entry = line.split('{')[1].split(',')[0]
-                entrylines = [line]
-            elif line[0] == '%':
-                continue
-            else:
-                entrylines += [line]
-
-        if entry is not None:
-            bibliography[entry] = entrylines
-        print("entries:",sorted(list(bibliography.keys())))
+    bibliography = read_bibliography(bibfile)
+    if args.verbose:
+        print("entries:",sorted(list(bibliography.keys())),file=LOG)
 
     # Obtain cited entries:
     cited = {k: e for k,e in bibliography.items() if k in document}
 
+    # Report the keys of \cite commands. The substring test above is
+    # kept for the new bibliography, since it also keeps entries
+    # referenced in other ways:
+    citations = find_citations(document)
+    if '*' in citations:
+        citations = citations.difference('*').union(bibliography)
+    report.record["bibliography"] = {
+        "file" : bibfile,
+        "cited" : sorted(k for k in bibliography if k in citations),
+        "uncited" : sorted(k for k in bibliography if k not in citations)
+    }
+    report.record["counts"]["bib_entries"] = len(bibliography)
+    report.record["counts"]["bib_cited"] \
+       = len(report.record["bibliography"]["cited"])
+    for key in sorted(citations.difference(bibliography)):
+        report.warn("Citation '" + key + "' not found in bibliography.")
+
     # Save the bibliography:
     newbib = OUTFILE.replace('.tex','.bib')
     with open(OUTDIR + "/" + newbib,'w') as f:
@@ -214,7 +225,12 @@ if len(split) == 2:
     document = split[0] + "\\bibliography{" + newbib + "}" + split[1]
     with open(OUTFILE, "w") as f:
         f.write(document)
-
+elif len(split) == 1:
+    report.warn("No \\bibliography command found.")
+else:
+    report.warn("Multiple \\bibliography commands found, bibliography "
+                "not processed.")
+report.stage("bibliography")
 
 
 
@@ -272,3 +288,13 @@ for f in imagefiles:
     src = f[0]+f[2]
     dst = OUTDIR + "/" + f[1] + f[2]
     copyfile(src, dst)
+report.record["figures"] = [{"source" : f[0] + f[2], "target" : f[1] + f[2]}
+                            for f in imagefiles]
+report.record["counts"]["figures"] = len(imagefiles)
+report.stage("figures")
+
+if args.report == 'json':
+    print(report.json())
+elif args.verbose:
+    for warning in report.record["warnings"]:
+        print("warning:",warning)
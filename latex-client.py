@@ -0,0 +1,31 @@
+#!/bin/python
+# Client for latex-server.py. Takes the name of the tool followed by
+# the usual command line arguments of that tool, e.g.
+#
+#    python latex-client.py clean-latex -i IN.tex -o OUT.tex -d OUTDIR
+#    python latex-client.py wordcount -i IN.tex --report json
+#
+# The job is run by the server in the current working directory.
+
+import json
+import os
+import socket
+import sys
+from libclean import DEFAULT_SOCKET
+
+SOCKET = os.environ.get("CLEAN_LATEX_SOCKET", DEFAULT_SOCKET)
+
+if len(sys.argv) < 2:
+    raise RuntimeError("No tool given. Use 'clean-latex' or 'wordcount'.")
+
+job = {"tool" : sys.argv[1], "args" : sys.argv[2:], "cwd" : os.getcwd()}
+
+with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+    s.connect(SOCKET)
+    s.sendall((json.dumps(job) + "\n").encode())
+    with s.makefile('r') as f:
+        result = json.loads(f.readline())
+
+sys.stdout.write(result["stdout"])
+sys.stderr.write(result["stderr"])
+sys.exit(result["returncode"])
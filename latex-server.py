@@ -0,0 +1,123 @@
+#!/bin/python
+# Long-running server for repeated cleaning and word count jobs.
+#
+# The server listens on a local Unix socket and runs clean-latex.py
+# and wordcount.py in a pool of worker processes. Each worker keeps
+# libclean imported, so that evaluated preambles, compiled command
+# tables, and parsed bibliographies are reused between jobs. The input
+# file itself is read and stripped of comments for every job.
+#
+# Jobs are sent by latex-client.py as one JSON line
+#    {"tool" : "clean-latex", "args" : [...], "cwd" : "..."}
+# and answered by one JSON line
+#    {"returncode" : 0, "stdout" : "...", "stderr" : "..."}
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import runpy
+import signal
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout, redirect_stderr
+from libclean import DEFAULT_SOCKET
+
+TOOLS = {"clean-latex" : "clean-latex.py", "wordcount" : "wordcount.py"}
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_tool(tool, args, cwd):
+    """
+    Run one of the scripts in the current process with command line
+    arguments `args` and working directory `cwd`.
+
+    Returns:
+       returncode, stdout, stderr
+    """
+    script = os.path.join(SCRIPT_DIR, TOOLS[tool])
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    argv = sys.argv
+    oldcwd = os.getcwd()
+    returncode = 0
+    try:
+        os.chdir(cwd)
+        sys.argv = [script] + list(args)
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                runpy.run_path(script, run_name="__main__")
+            except SystemExit as e:
+                if e.code is None:
+                    returncode = 0
+                elif isinstance(e.code, int):
+                    returncode = e.code
+                else:
+                    print(e.code, file=sys.stderr)
+                    returncode = 1
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+    finally:
+        sys.argv = argv
+        os.chdir(oldcwd)
+    return returncode, stdout.getvalue(), stderr.getvalue()
+
+
+async def handle(reader, writer, executor):
+    """
+    Read one job from a client, run it, and send back the result.
+    """
+    try:
+        job = json.loads(await reader.readline())
+        if job.get("tool") not in TOOLS:
+            result = (2, "", "Unknown tool '" + str(job.get("tool")) + "'.\n")
+        else:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(executor, run_tool,
+                                                job["tool"], job["args"],
+                                                job["cwd"])
+    except Exception:
+        result = (1, "", traceback.format_exc())
+    writer.write((json.dumps({"returncode" : result[0], "stdout" : result[1],
+                              "stderr" : result[2]}) + "\n").encode())
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(socket, workers):
+    """
+    Serve jobs on the Unix socket `socket` until SIGINT or SIGTERM.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        server = await asyncio.start_unix_server(
+            lambda r, w: handle(r, w, executor), path=socket)
+        print("Listening on", socket, flush=True)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            os.remove(socket)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', action='store', type=str,
+                        default=DEFAULT_SOCKET)
+    parser.add_argument('--workers', action='store', type=int,
+                        default=os.cpu_count())
+    args = parser.parse_args()
+
+    if os.path.exists(args.socket):
+        raise RuntimeError("Socket '" + args.socket + "' exists. Is another "
+                           "server running?")
+
+    asyncio.run(serve(args.socket, args.workers))
@@ -1,33 +1,185 @@
 # Utility code used in multiple scripts.
 
-def remove_comments(infile, outfile):
+import os
+import re
+import json
+from collections import OrderedDict
+from tempfile import gettempdir
+from time import perf_counter
+from types import MappingProxyType
+
+# Socket used by latex-server.py and latex-client.py:
+DEFAULT_SOCKET = os.path.join(gettempdir(),
+                              "clean-latex-" + str(os.getuid()) + ".sock")
+
+# Hits and misses of the in-memory caches. The caches only pay off in a
+# long-running process such as latex-server.py:
+_CACHE_SIZE = 32
+_CACHE_STATS = {name : {"hits" : 0, "misses" : 0}
+                for name in ("preamble", "commands", "bibliography")}
+
+
+def _cache_get(cache, name, key):
+    """
+    Return the value for `key` from the least-recently-used cache
+    `cache`, or None, and count the hit or miss for cache `name`.
+    """
+    value = cache.get(key)
+    if value is None:
+        _CACHE_STATS[name]["misses"] += 1
+    else:
+        _CACHE_STATS[name]["hits"] += 1
+        cache.move_to_end(key)
+    return value
+
+
+def _cache_put(cache, key, value):
+    """
+    Insert `value` into the least-recently-used cache `cache`.
+    """
+    cache[key] = value
+    if len(cache) > _CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+_VERBATIM = re.compile(r'\\begin\{(verbatim\*?)\}')
+_EMPTY_LINES = re.compile(r'\n\n\n+')
+
+
+def _find_comment(line, i=0):
+    r"""
+    Return the index of the first unescaped '%' in `line` at or after
+    index `i`, or -1. A '%' is escaped if it follows an odd number of
+    backslashes, so '\%' is text while '\\%' starts a comment.
+    """
+    i = line.find('%', i)
+    while i > 0 and line[i-1] == '\\':
+        k = i - 1
+        while k > 0 and line[k-1] == '\\':
+            k -= 1
+        if (i - k) % 2 == 0:
+            break
+        i = line.find('%', i+1)
+    return i
+
+
+def _uncomment(line):
+    """
+    Remove the comment and surrounding whitespace from `line`.
+    """
+    i = line.find('%')
+    if i > 0 and line[i-1] == '\\':
+        i = _find_comment(line, i)
+    if i < 0:
+        return line.strip()
+    return line[:i].lstrip() + '%'
+
+
+def _strip_comment(line):
+    r"""
+    Remove the comment from a single `line` whose leading whitespace
+    has already been removed. Text following a \begin{verbatim} is
+    kept unchanged up to and including the matching \end{verbatim}.
+
+    Returns the line and the command which closes a verbatim
+    environment left open at the end of the line, or None.
+    """
+    parts = []
+    while True:
+        i = _find_comment(line)
+        if i < 0:
+            text, comment = line, False
+        else:
+            text, comment = line[:i], True
+        verb = _VERBATIM.search(text)
+        if verb is None:
+            parts.append(text + '%' if comment else line.rstrip())
+            return "".join(parts), None
+        end = '\\end{' + verb.group(1) + '}'
+        j = line.find(end, verb.end())
+        if j < 0:
+            parts.append(line)
+            return "".join(parts), end
+        j += len(end)
+        parts.append(line[:j])
+        line = line[j:]
+
+
+def remove_comments(infile, outfile, blocksize=1 << 20):
     """
     Parse a LaTeX file `infile`, remove comments, and
     write to `outfile`.
+
+    The file is read in blocks of `blocksize` characters, which are
+    processed at once unless they contain verbatim environments. Text
+    within verbatim environments is copied unchanged.
     """
     can_have_empty = False
-    for line in infile:
-        if '\\%' in line:
-            split = line.strip().split('\%')
-            recombine = []
-            for s in split:
-                if '%' in s:
-                    recombine += [s.split('%')[0] + "%"]
-                    break
-                else:
-                    recombine += [s]
-            line = '\\%'.join(recombine)
+    verbatim_end = None
+    tail = ''
+    while True:
+        chunk = infile.read(blocksize)
+        buffer = tail + chunk
+        if len(chunk) == 0:
+            # Last line without a terminating newline:
+            if len(buffer) == 0:
+                break
+            tail = ''
         else:
-            if "%" in line:
-                line = line.strip().split('%')[0] + "%"
+            # Only process complete lines:
+            i = buffer.rfind('\n')
+            if i < 0:
+                tail = buffer
+                continue
+            buffer, tail = buffer[:i], buffer[i+1:]
+
+        if verbatim_end is None and '\\begin{verbatim' not in buffer:
+            # Process the whole block at once. Runs of empty lines are
+            # reduced to a single one, and empty lines are dropped at the
+            # start of the file and after an empty line:
+            lines = buffer.split('\n')
+            if '\\%' not in buffer:
+                # Every '%' starts a comment:
+                lines = [line.strip() if '%' not in line
+                         else line[:line.index('%')].lstrip() + '%'
+                         for line in lines]
+            else:
+                lines = [line.strip() if '%' not in line
+                         else _uncomment(line) for line in lines]
+            text = '\n' + '\n'.join(lines) + '\n'
+            if can_have_empty:
+                text = _EMPTY_LINES.sub('\n\n', text)[1:]
             else:
-                line = line.strip()
-        if len(line) > 0:
-            can_have_empty = True
-            outfile.write(line + '\n')
-        elif can_have_empty:
-            outfile.write('\n')
-            can_have_empty = False
+                text = _EMPTY_LINES.sub('\n\n', text.lstrip('\n'))
+            can_have_empty = len(text) > 1 and text[-2] != '\n'
+        else:
+            # Line by line, tracking verbatim environments:
+            out = []
+            for line in buffer.split('\n'):
+                if verbatim_end is not None:
+                    j = line.find(verbatim_end)
+                    if j < 0:
+                        can_have_empty = True
+                        out.append(line + '\n')
+                        continue
+                    j += len(verbatim_end)
+                    rest, verbatim_end = _strip_comment(line[j:])
+                    line = line[:j] + rest
+                elif '\\begin{verbatim' in line:
+                    line, verbatim_end = _strip_comment(line.lstrip())
+                else:
+                    line = _uncomment(line)
+                if len(line) > 0:
+                    can_have_empty = True
+                    out.append(line + '\n')
+                elif can_have_empty:
+                    out.append('\n')
+                    can_have_empty = False
+            text = "".join(out)
+        outfile.write(text)
+
+        if len(chunk) == 0:
+            break
 
 def getscope(string, i0, begin='{',end='}'):
     """
@@ -60,48 +212,26 @@ def getscope(string, i0, begin='{',end='}'):
         i1 += 1
     return string[i0+1:i1-1], i1
 
-def evaluate_header(src, dest=None, defines=[], commands={}):
-    r"""
-    Read the header, collecting define-guards and command defines.
-    Performs the following tasks:
-      (1) Evaluate \ifdefined guards in the header, choosing alternatives
-          according to the list of defines given in `defines` parameter.
-      (2) Parse \newcommand and create a hierachic list of parameter evaluation.
-          This allows to replace all customly defined parameters by their
-          definition.
-      (3) Parse \newenvironment. Same as above.
+# Check whether the \fi command is in the string:
+_BREAKING_CHARS = ['\\', ' ', '%'] + [str(i)[0] for i in range(10)]
+def _check_fi(string):
+    if '\\fi' not in string:
+        return False
+    substr = string.split("\\fi")[1]
+    if len(substr) == 0:
+        return True
+    return substr[0] in _BREAKING_CHARS
 
-    Arguments:
-       src:  File handle of a .tex file to read.
 
-    Keyword arguments:
-       dest:     File handle to write the processed .tex document to. Can be None
-                 to not write the results to a file.
-                 Default: None
-       defines:  List of defines to evaluate the header \ifdefined structure.
-                 Default: []
-       commands: Dictionary of predefined commands.
-                 Default: {}
-
-    Returns:
-       lines, commands, commands_order
+def _evaluate_lines(src, defines, commands, lines, command_order, iftrue):
+    r"""
+    Evaluate the lines `src` for evaluate_header. The state of the
+    evaluation, `commands`, `lines`, `command_order`, and the stack
+    of \ifdefined conditions `iftrue`, is updated in place.
     """
-    lines = []
-    command_order = []
-    iftrue = [True]
-    iflevel = 0
+    iflevel = len(iftrue) - 1
     prefix = ''
 
-    # Check whether the \fi command is in the string:
-    breaking_chars = ['\\', ' ', '%'] + [str(i)[0] for i in range(10)]
-    def check_fi(string):
-        if '\\fi' not in string:
-            return False
-        substr = string.split("\\fi")[1]
-        if len(substr) == 0:
-            return True
-        return substr[0] in breaking_chars
-
     for line in src:
         line = line.replace("\n","")
         if '\\ifdefined' in line:
@@ -116,7 +246,7 @@ def evaluate_header(src, dest=None, defines=[], commands={}):
             if iflevel > 0:
                 iftrue[iflevel] = iftrue[iflevel] and iftrue[iflevel-1]
             continue
-        elif check_fi(line):
+        elif _check_fi(line):
             iftrue.pop()
             iflevel -= 1
             continue
@@ -161,6 +291,63 @@ def evaluate_header(src, dest=None, defines=[], commands={}):
             if iftrue[iflevel] and line != '%':
                 lines.append(prefix + line)
 
+
+# Evaluated preambles, keyed on the preamble, defines, and commands:
+_PREAMBLES = OrderedDict()
+
+
+def evaluate_header(src, dest=None, defines=[], commands={}):
+    r"""
+    Read the header, collecting define-guards and command defines.
+    Performs the following tasks:
+      (1) Evaluate \ifdefined guards in the header, choosing alternatives
+          according to the list of defines given in `defines` parameter.
+      (2) Parse \newcommand and create a hierachic list of parameter evaluation.
+          This allows to replace all customly defined parameters by their
+          definition.
+      (3) Parse \newenvironment. Same as above.
+
+    The state after evaluating the preamble, i.e. the lines before
+    \begin{document}, is kept in memory and reused for documents with
+    the same preamble, defines, and predefined commands.
+
+    Arguments:
+       src:  File handle of a .tex file to read.
+
+    Keyword arguments:
+       dest:     File handle to write the processed .tex document to. Can be None
+                 to not write the results to a file.
+                 Default: None
+       defines:  List of defines to evaluate the header \ifdefined structure.
+                 Default: []
+       commands: Dictionary of predefined commands.
+                 Default: {}
+
+    Returns:
+       lines, commands, commands_order
+    """
+    src = list(src)
+    n = next((i for i,line in enumerate(src) if '\\begin{document}' in line),
+             len(src))
+    key = (tuple(src[:n]), tuple(defines), tuple(commands.items()))
+    cached = _cache_get(_PREAMBLES, "preamble", key)
+    if cached is None:
+        lines = []
+        command_order = []
+        iftrue = [True]
+        _evaluate_lines(src[:n], defines, commands, lines, command_order,
+                        iftrue)
+        _cache_put(_PREAMBLES, key, (tuple(lines), dict(commands),
+                                     tuple(command_order), tuple(iftrue)))
+    else:
+        lines = list(cached[0])
+        commands.update(cached[1])
+        command_order = list(cached[2])
+        iftrue = list(cached[3])
+
+    # The document body:
+    _evaluate_lines(src[n:], defines, commands, lines, command_order, iftrue)
+
     if dest is not None:
         with open(dest, 'w') as f:
             f.writelines(lines)
@@ -196,21 +383,50 @@ def replace_single_command(string, cmd, commands):
     return "".join(dnew)
 
 
-def replace_commands(document, command_order, commands,
-                     command_dict_inplace=True):
+# Compiled command tables of previously seen preambles:
+_COMPILED_COMMANDS = OrderedDict()
+
+
+def compile_commands(command_order, commands):
     """
-    Iteratively evaluates commands within a document.
+    Iteratively evaluates the commands within the definitions of
+    all following commands.
+
+    Returns a tuple of (cmd, nargs, definition) in the order of
+    evaluation, where each definition has all previous commands
+    expanded. The results are kept in memory, keyed on the command
+    definitions, so that repeated calls with the same preamble do
+    not evaluate it again.
     """
-    if not command_dict_inplace:
-        commands = {**commands}
+    key = tuple((cmd, commands[cmd]) for cmd in command_order)
+    compiled = _cache_get(_COMPILED_COMMANDS, "commands", key)
+    if compiled is not None:
+        return compiled
+    commands = {**commands}
+    compiled = []
     for i,cmd in enumerate(command_order):
-        # Replace in document:
-        document = replace_single_command(document, cmd, commands)
+        compiled.append((cmd,) + commands[cmd])
         # Replace in all following commands:
         for c2 in command_order[i+1:]:
             commands[c2] = (commands[c2][0],
                             replace_single_command(commands[c2][1], cmd,
                                                    commands))
+    compiled = tuple(compiled)
+    _cache_put(_COMPILED_COMMANDS, key, compiled)
+    return compiled
+
+
+def replace_commands(document, command_order, commands,
+                     command_dict_inplace=True):
+    """
+    Iteratively evaluates commands within a document.
+    """
+    if not command_dict_inplace:
+        commands = {**commands}
+    for cmd, nargs, definition in compile_commands(command_order, commands):
+        document = replace_single_command(document, cmd,
+                                          {cmd : (nargs, definition)})
+        commands[cmd] = (nargs, definition)
 
     return document, commands
 
@@ -263,3 +479,110 @@ def replace_environment(document, environment, replace_by):
             docnew.append(replace_by(s2[0]))
             docnew.append(s2[1])
     return "".join(docnew)
+
+
+# Citation commands such as \cite, \citep, \citet*, \citeauthor or \nocite,
+# with optional arguments, and their list of keys:
+_CITATION = re.compile(r'\\(?:no)?cite[a-zA-Z]*\*?\s*(?:\[[^\]]*\]\s*)*'
+                       r'\{([^}]*)\}')
+
+
+def find_citations(document):
+    r"""
+    Return the set of bibliography keys cited in `document` by
+    \cite-like commands. A \nocite{*} is returned as the key '*'.
+    """
+    keys = set()
+    for m in _CITATION.finditer(document):
+        keys.update(k.strip() for k in m.group(1).split(','))
+    keys.discard('')
+    return keys
+
+
+# Parsed bibliographies, keyed on the absolute file name, modification
+# time, and size:
+_BIBLIOGRAPHIES = OrderedDict()
+
+
+def read_bibliography(bibfile):
+    """
+    Read a .bib file and return a read-only mapping of the entry keys
+    to the tuple of stripped lines of each entry.
+
+    The parsed bibliography is kept in memory and reused as long as
+    the modification time and size of the file do not change.
+    """
+    path = os.path.abspath(bibfile)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    bibliography = _cache_get(_BIBLIOGRAPHIES, "bibliography", key)
+    if bibliography is not None:
+        return bibliography
+
+    bibliography = dict()
+    with open(bibfile, 'r') as f:
+        entry = None
+        entrylines = []
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line[0] == '%':
+                continue
+            if line[0] == '@':
+                assert '{' in line
+                assert line[-1] == ','
+                if entry is not None:
+                    bibliography[entry] = tuple(entrylines)
+                entry = line.split('{')[1].split(',')[0]
+                entrylines = [line]
+            elif line[0] == '%':
+                continue
+            else:
+                entrylines += [line]
+
+        if entry is not None:
+            bibliography[entry] = tuple(entrylines)
+
+    bibliography = MappingProxyType(bibliography)
+    _cache_put(_BIBLIOGRAPHIES, key, bibliography)
+    return bibliography
+
+
+class Report:
+    """
+    Collects a machine-readable summary of a run: counts, warnings,
+    further results, and the durations of the processing stages.
+    """
+    def __init__(self, tool):
+        self.record = {"tool" : tool, "counts" : {}, "warnings" : [],
+                       "timings" : {}}
+        self._t0 = perf_counter()
+        self._cache_stats = {name : dict(stats)
+                             for name, stats in _CACHE_STATS.items()}
+
+    def stage(self, name):
+        """
+        Record the time elapsed since the end of the previous stage
+        as the duration of stage `name`.
+        """
+        t = perf_counter()
+        self.record["timings"][name] = t - self._t0
+        self._t0 = t
+
+    def warn(self, message):
+        """
+        Add a warning to the report.
+        """
+        self.record["warnings"].append(message)
+
+    def json(self):
+        """
+        Return the report as a single-line JSON string. The hits and
+        misses of the in-memory caches since the creation of the report
+        are included as "caches".
+        """
+        self.record["caches"] = {
+            name : {k : stats[k] - self._cache_stats[name][k]
+                    for k in stats}
+            for name, stats in _CACHE_STATS.items()
+        }
+        return json.dumps(self.record)
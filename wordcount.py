@@ -6,7 +6,7 @@ import argparse
 import os
 from tempfile import TemporaryFile
 from libclean import remove_comments, evaluate_header, replace_commands, \
-                     replace_inline_math_mode, replace_environment
+                     replace_inline_math_mode, replace_environment, Report
 parser = argparse.ArgumentParser()
 parser.add_argument('-i', action='store', type=str)
 #parser.add_argument('-o', action='store', type=str)
@@ -16,7 +16,9 @@ parser.add_argument('--count-section-headings', action='store_true')
 parser.add_argument('--count-appendix', action='store_true')
 parser.add_argument('--count-figure-captions', action='store_true')
 parser.add_argument('--count-table-captions', action='store_true')
+parser.add_argument('--report', choices=('text','json'), default='text')
 args = parser.parse_args()
+report = Report("wordcount")
 
 # Parsing the arguments:
 FILE = args.i
@@ -41,7 +43,7 @@ if KEEP_TMP_OUTFILE:
 with TemporaryFile(mode='w+') as out:
     with open(FILE, 'r') as f:
         remove_comments(f, out)
-
+    report.stage("remove_comments")
 
     ############################################################################
     # 2. Define some commands which should not have an effect on word count,   #
@@ -110,6 +112,8 @@ if CL_REVISION_COMMANDS:
                       "\\deletedincaption", "\\listofchanges","\\replacedlabel",
                       "\\drafttrue", "\\countchange"]
 command_order = command_order[::-1]
+report.record["counts"]["commands"] = len(command_order)
+report.stage("evaluate_header")
 
 
 # TODO this is a hotfix. Should be possible to specify optional argument numbers.
@@ -118,6 +122,7 @@ document = "\n".join(LINES).replace('\includegraphics{','\includegraphics[scale=
 
 # Replace the custom commands:
 document, commands = replace_commands(document, command_order, commands)
+report.stage("replace_commands")
 
 
 ################################
@@ -143,7 +148,7 @@ if COUNT_SEPARATE_MATHMODE:
     document = replace_environment(document, "align", "SEPARATEEQN")
 else:
     document = replace_environment(document, "align", "")
-
+report.stage("mathmode")
 
 
 ##################################
@@ -164,7 +169,7 @@ if REMOVE_TABLES:
 else:
     document = replace_environment(document, "table", lambda x : x)
     document = replace_environment(document, "table*", lambda x : x)
-
+report.stage("figures_tables")
 
 ########################
 # 7. Remove appendix:  #
@@ -187,10 +192,17 @@ document = "\n".join(line for line in document.splitlines()
 # Some splitting:
 document = document.replace("\n"," ").replace(","," ").replace("?"," ")\
                    .replace("-"," ").strip()
+nwords = len(document.split())
+report.stage("count")
 
 ##############################
 # 9. Output the word count!  #
 ##############################
-print("#words:  ",len(document.split()))
-print("#figures:",nfig)
-print("#tables: ",ntab)
+if args.report == 'json':
+    report.record["counts"] |= {"words" : nwords, "figures" : nfig,
+                                "tables" : ntab}
+    print(report.json())
+else:
+    print("#words:  ",nwords)
+    print("#figures:",nfig)
+    print("#tables: ",ntab)